@@ -1,11 +1,24 @@
 """Configuration useful across different tests."""
+import os
 import pathlib
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pytest
 import rasterio as rio  # type: ignore
 
+from ukis_sat2h5 import conversion
+
+# size of fixture images, kept small as tests check structure rather than pixel throughput. It is
+# deliberately no multiple of the tile sizes used in tests, so padding is exercised as well.
+FIXTURE_W = FIXTURE_H = 250
+
+# one seeded generator for the whole session; random payloads are only generated once per signature
+# and then shifted per fixture image, so that images and labels still differ between files
+_RNG = np.random.default_rng(0)
+_ARR_CACHE: dict[tuple, np.ndarray] = {}
+
 
 @pytest.fixture(scope="session")
 def single_image_folder(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
@@ -15,38 +28,90 @@ def single_image_folder(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Pat
 
     # create image
     img_file_name = single_image_folder / "img.tif"
-    _create_image(img_file_name, 0, 255, 4, 999, 999, np.dtype("uint8"))
+    _create_image(img_file_name, 0, 255, 4, FIXTURE_H, FIXTURE_W, np.dtype("uint8"))
 
     # create label
     lbl_file_name = single_image_folder / "label.tif"
-    _create_image(lbl_file_name, 0, 3, None, 999, 999, np.dtype("uint8"))
+    _create_image(lbl_file_name, 0, 3, None, FIXTURE_H, FIXTURE_W, np.dtype("uint8"))
 
     # return folder name
-    yield single_image_folder
+    return single_image_folder
+
+
+@pytest.fixture(scope="session")
+def uncompressed_image_folder(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
+    """Fixture to reuse an uncompressed image for tests only checking shapes and padding."""
+    uncompressed_image_folder = tmp_path_factory.mktemp("uncompressed_image_folder")
 
-    # clean up after session
-    shutil.rmtree(single_image_folder)
+    # create image and label
+    img_file_name = uncompressed_image_folder / "img.tif"
+    _create_image(img_file_name, 0, 255, 4, FIXTURE_H, FIXTURE_W, np.dtype("uint8"), None)
+    lbl_file_name = uncompressed_image_folder / "label.tif"
+    _create_image(lbl_file_name, 0, 3, None, FIXTURE_H, FIXTURE_W, np.dtype("uint8"), None)
+
+    return uncompressed_image_folder
 
 
 @pytest.fixture(scope="session")
 def multiple_image_folder(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
     """Fixture to reuse image folder with multiple image files across tests."""
     multiple_image_folder = tmp_path_factory.mktemp("multiple_image_folder")
-    for i in range(10):
-        # create image
-        folder = multiple_image_folder / f"image_{i}"
-        folder.mkdir()
-        img_file_name = folder / f"img_{i}.tif"
-        _create_image(img_file_name, 0, 255, 4, 999, 999, np.dtype("uint8"))
+    _create_image_folders(multiple_image_folder, 10)
+
+    return multiple_image_folder
+
 
-        # create label
-        lbl_file_name = folder / "label.tif"
-        _create_image(lbl_file_name, 0, 3, None, 999, 999, np.dtype("uint8"))
+@pytest.fixture(scope="session")
+def small_multiple_image_folder(tmp_path_factory: pytest.TempPathFactory) -> pathlib.Path:
+    """Fixture to reuse image folder with just enough image files for index based tests."""
+    small_multiple_image_folder = tmp_path_factory.mktemp("small_multiple_image_folder")
+    _create_image_folders(small_multiple_image_folder, 3)
+
+    return small_multiple_image_folder
 
-    yield multiple_image_folder
 
-    # clean up after session
-    shutil.rmtree(multiple_image_folder)
+@pytest.fixture(scope="session")
+def small_multiple_h5_file(
+    small_multiple_image_folder: pathlib.Path, tmp_path_factory: pytest.TempPathFactory
+) -> pathlib.Path:
+    """Fixture to convert the small multiple image folder to h5 once for all index based tests."""
+    h5_file = tmp_path_factory.mktemp("small_multiple_h5") / "img.h5"
+    conversion.convert_img_to_h5(
+        src_path=small_multiple_image_folder,
+        dst_file=h5_file,
+        file_glob="*.tif",
+        label_glob="*label*",
+        image_bands=[1, 2, 3, 4],
+    )
+
+    return h5_file
+
+
+@pytest.fixture()
+def multiple_image_folder_copy(
+    multiple_image_folder: pathlib.Path, tmp_path: pathlib.Path
+) -> pathlib.Path:
+    """Fixture providing a private copy of the multiple image folder for tests adding files."""
+    return shutil.copytree(multiple_image_folder, tmp_path / "multiple_image_folder")
+
+
+def _create_image_folders(root_folder: pathlib.Path, nimages: int) -> None:
+    # GDAL releases the GIL while encoding and writing, so image pairs can be written concurrently
+    with ThreadPoolExecutor(max_workers=min(nimages, os.cpu_count() or 1)) as executor:
+        list(executor.map(_create_image_pair, [root_folder] * nimages, range(nimages)))
+
+
+def _create_image_pair(root_folder: pathlib.Path, i: int) -> None:
+    folder = root_folder / f"image_{i}"
+    folder.mkdir()
+
+    # create image
+    img_file_name = folder / f"img_{i}.tif"
+    _create_image(img_file_name, 0, 255, 4, FIXTURE_H, FIXTURE_W, np.dtype("uint8"), shift=i)
+
+    # create label
+    lbl_file_name = folder / "label.tif"
+    _create_image(lbl_file_name, 0, 3, None, FIXTURE_H, FIXTURE_W, np.dtype("uint8"), shift=i)
 
 
 def _create_image(
@@ -57,11 +122,17 @@ def _create_image(
     nrows: int,
     ncols: int,
     dtype: np.dtype,
+    compress: str | None = "deflate",
+    shift: int = 0,
 ) -> None:
+    """Write a random raster, `shift` rolls its pixels and moves its transform to make it unique."""
     if not nbands:
         nbands = 1
     dims = tuple(i for i in (nbands, nrows, ncols) if i)  # filter None dimensions
-    img_arr = np.random.default_rng().integers(min_val, max_val, dims, dtype=dtype)
+    key = (nbands, nrows, ncols, dtype.str, min_val, max_val)
+    if key not in _ARR_CACHE:
+        _ARR_CACHE[key] = _RNG.integers(min_val, max_val, dims, dtype=dtype)
+    img_arr = np.roll(_ARR_CACHE[key], shift, axis=-1)
 
     meta = {
         "driver": "GTiff",
@@ -69,10 +140,17 @@ def _create_image(
         "width": ncols,
         "height": nrows,
         "dtype": dtype,
-        "compress": "lzw",
         "crs": rio.crs.CRS().from_epsg("32601"),
-        "transform": rio.Affine.from_gdal(0.0, 10.0, 0.0, 0.0, 0.0, -10.0),
+        "transform": rio.Affine.from_gdal(shift * 10.0 * ncols, 10.0, 0.0, 0.0, 0.0, -10.0),
     }
+    if compress:
+        # random data barely compresses, so keep encoding cheap; tiles speed up windowed reads
+        meta.update(
+            {"compress": compress, "zlevel": 1, "tiled": True, "blockxsize": 256, "blockysize": 256}
+        )
+    else:
+        # plain striped GeoTIFF without any encoding overhead
+        meta.update({"tiled": False, "bigtiff": "no"})
 
     with rio.open(img_file_name, "w", **meta) as dst:
         dst.write(img_arr)
@@ -1,24 +1,29 @@
 """Test contents of ukis_sat2h5/conversion.py."""
+import importlib
 import pathlib
 import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
+import h5py  # type: ignore
 import numpy as np
 import pytest
 import rasterio as rio  # type: ignore
 
-from tests.conftest import _create_image
-from ukis_sat2h5 import conversion
+from tests.conftest import FIXTURE_H, FIXTURE_W, _create_image
+from ukis_sat2h5 import _compression, conversion
+from ukis_sat2h5._compression import bitshuffle
 
-SINGLE_IMAGE_FOLDER_IMAGE_WIDTH = 999
-SINGLE_IMAGE_FOLDER_IMAGE_HEIGHT = 999
+SINGLE_IMAGE_FOLDER_IMAGE_WIDTH = FIXTURE_W
+SINGLE_IMAGE_FOLDER_IMAGE_HEIGHT = FIXTURE_H
 SINGLE_IMAGE_FOLDER_IMAGE_EPSG = 32601
 SINGLE_IMAGE_FOLDER_IMAGE_BANDS = 4
 
 
-def test_single_img_to_h5_to_img(single_image_folder: pathlib.Path) -> None:
+def test_single_img_to_h5_to_img(single_image_folder: pathlib.Path, tmp_path: pathlib.Path) -> None:
     """Test conversion to and from h5 results in identical raster."""
     # convert one image to h5
-    h5_file = single_image_folder / "img.h5"
+    h5_file = tmp_path / "img.h5"
     conversion.convert_img_to_h5(
         src_path=single_image_folder,
         dst_file=h5_file,
@@ -27,43 +32,24 @@ def test_single_img_to_h5_to_img(single_image_folder: pathlib.Path) -> None:
     )
 
     # convert h5 back to image
-    roundtrip_image_folder = single_image_folder / "img_roundtrip"
+    roundtrip_image_folder = tmp_path / "img_roundtrip"
     conversion.convert_h5_to_img(src_file=h5_file, dst_folder=roundtrip_image_folder, index=None)
 
-    # open both arrays and check whether they match
-    with (
-        rio.open(single_image_folder / "img.tif", "r") as original_image,
-        rio.open(single_image_folder / "label.tif", "r") as original_label,
-        rio.open(roundtrip_image_folder / "img.tif", "r") as roundtrip_image,
-        rio.open(roundtrip_image_folder / "img_label.tif", "r") as roundtrip_label,
-    ):
-        arr_img_original = original_image.read()
-        arr_lbl_original = original_label.read()
-        arr_img_roundtrip = roundtrip_image.read()
-        arr_lbl_roundtrip = roundtrip_label.read()
-
-        assert (arr_img_original == arr_img_roundtrip).all()
-        assert (arr_lbl_original == arr_lbl_roundtrip).all()
-
-        assert original_image.meta["width"] == roundtrip_image.meta["width"]
-        assert original_image.meta["height"] == roundtrip_image.meta["height"]
-        assert original_image.meta["transform"] == roundtrip_image.meta["transform"]
-        assert original_image.meta["crs"] == roundtrip_image.meta["crs"]
-
-        assert original_label.meta["width"] == roundtrip_label.meta["width"]
-        assert original_label.meta["height"] == roundtrip_label.meta["height"]
-        assert original_label.meta["transform"] == roundtrip_label.meta["transform"]
-        assert original_label.meta["crs"] == roundtrip_label.meta["crs"]
-
-    # cleanup
-    h5_file.unlink()
-    shutil.rmtree(roundtrip_image_folder)
-
-
-def test_multiple_image_to_h5_to_img(multiple_image_folder: pathlib.Path) -> None:
+    # read both arrays and check whether they match
+    _assert_roundtrip_matches(
+        single_image_folder / "img.tif",
+        single_image_folder / "label.tif",
+        roundtrip_image_folder / "img.tif",
+        roundtrip_image_folder / "img_label.tif",
+    )
+
+
+def test_multiple_image_to_h5_to_img(
+    multiple_image_folder: pathlib.Path, tmp_path: pathlib.Path
+) -> None:
     """Test conversion to and from h5 results in identical raster."""
     # convert one image to h5
-    h5_file = multiple_image_folder / "img.h5"
+    h5_file = tmp_path / "img.h5"
     conversion.convert_img_to_h5(
         src_path=multiple_image_folder,
         dst_file=h5_file,
@@ -73,134 +59,115 @@ def test_multiple_image_to_h5_to_img(multiple_image_folder: pathlib.Path) -> Non
     )
 
     # convert h5 back to image
-    roundtrip_image_folder = multiple_image_folder / "img_roundtrip"
+    roundtrip_image_folder = tmp_path / "img_roundtrip"
     conversion.convert_h5_to_img(src_file=h5_file, dst_folder=roundtrip_image_folder, index=None)
 
-    # open both arrays and check whether they match
+    # read both arrays and check whether they match
     for i in range(9):
-        with (
-            rio.open(multiple_image_folder / f"image_{i}" / f"img_{i}.tif", "r") as original_image,
-            rio.open(multiple_image_folder / f"image_{i}" / "label.tif", "r") as original_label,
-            rio.open(roundtrip_image_folder / f"img_{i}.tif", "r") as roundtrip_image,
-            rio.open(roundtrip_image_folder / f"img_{i}_label.tif", "r") as roundtrip_label,
-        ):
-            arr_img_original = original_image.read()
-            arr_lbl_original = original_label.read()
-            arr_img_roundtrip = roundtrip_image.read()
-            arr_lbl_roundtrip = roundtrip_label.read()
-
-            assert (arr_img_original == arr_img_roundtrip).all()
-            assert (arr_lbl_original == arr_lbl_roundtrip).all()
-
-            assert original_image.meta["width"] == roundtrip_image.meta["width"]
-            assert original_image.meta["height"] == roundtrip_image.meta["height"]
-            assert original_image.meta["transform"] == roundtrip_image.meta["transform"]
-            assert original_image.meta["crs"] == roundtrip_image.meta["crs"]
-
-            assert original_label.meta["width"] == roundtrip_label.meta["width"]
-            assert original_label.meta["height"] == roundtrip_label.meta["height"]
-            assert original_label.meta["transform"] == roundtrip_label.meta["transform"]
-            assert original_label.meta["crs"] == roundtrip_label.meta["crs"]
-
-    # cleanup
-    h5_file.unlink()
-    shutil.rmtree(roundtrip_image_folder)
-
-
-def test_single_index_conversion(multiple_image_folder: pathlib.Path) -> None:
+        _assert_roundtrip_matches(
+            multiple_image_folder / f"image_{i}" / f"img_{i}.tif",
+            multiple_image_folder / f"image_{i}" / "label.tif",
+            roundtrip_image_folder / f"img_{i}.tif",
+            roundtrip_image_folder / f"img_{i}_label.tif",
+        )
+
+
+@pytest.mark.parametrize("index", [2, [2]])
+def test_single_index_conversion(
+    small_multiple_image_folder: pathlib.Path,
+    small_multiple_h5_file: pathlib.Path,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    index: int | list[int],
+) -> None:
     """Test conversion to and from h5 results in identical raster with a single index."""
-    # convert one image to h5
-    h5_file = multiple_image_folder / "img.h5"
-    conversion.convert_img_to_h5(
-        src_path=multiple_image_folder,
-        dst_file=h5_file,
-        file_glob="*.tif",
-        label_glob="*label*",
-        image_bands=[1, 2, 3, 4],
+    # convert h5 back to image, without starting worker processes
+    monkeypatch.setattr(conversion.multiprocessing, "Pool", None)
+    roundtrip_image_folder = tmp_path / "img_roundtrip"
+    conversion.convert_h5_to_img(
+        src_file=small_multiple_h5_file, dst_folder=roundtrip_image_folder, index=index
     )
 
-    # convert h5 back to image
-    roundtrip_image_folder = multiple_image_folder / "img_roundtrip"
-    conversion.convert_h5_to_img(src_file=h5_file, dst_folder=roundtrip_image_folder, index=5)
-
-    with (
-        rio.open(multiple_image_folder / "image_5" / "img_5.tif", "r") as original_image,
-        rio.open(multiple_image_folder / "image_5" / "label.tif", "r") as original_label,
-        rio.open(roundtrip_image_folder / "img_5.tif", "r") as roundtrip_image,
-        rio.open(roundtrip_image_folder / "img_5_label.tif", "r") as roundtrip_label,
-    ):
-        arr_img_original = original_image.read()
-        arr_lbl_original = original_label.read()
-        arr_img_roundtrip = roundtrip_image.read()
-        arr_lbl_roundtrip = roundtrip_label.read()
-
-        assert (arr_img_original == arr_img_roundtrip).all()
-        assert (arr_lbl_original == arr_lbl_roundtrip).all()
-
-        assert original_image.meta["width"] == roundtrip_image.meta["width"]
-        assert original_image.meta["height"] == roundtrip_image.meta["height"]
-        assert original_image.meta["transform"] == roundtrip_image.meta["transform"]
-        assert original_image.meta["crs"] == roundtrip_image.meta["crs"]
-
-        assert original_label.meta["width"] == roundtrip_label.meta["width"]
-        assert original_label.meta["height"] == roundtrip_label.meta["height"]
-        assert original_label.meta["transform"] == roundtrip_label.meta["transform"]
-        assert original_label.meta["crs"] == roundtrip_label.meta["crs"]
-
-    # cleanup
-    h5_file.unlink()
-    shutil.rmtree(roundtrip_image_folder)
-
-
-def test_index_list_conversion(multiple_image_folder: pathlib.Path) -> None:
-    """Test conversion to and from h5 results in identical raster with a single index."""
-    # convert one image to h5
-    h5_file = multiple_image_folder / "img.h5"
-    conversion.convert_img_to_h5(
-        src_path=multiple_image_folder,
-        dst_file=h5_file,
-        file_glob="*.tif",
-        label_glob="*label*",
-        image_bands=[1, 2, 3, 4],
+    # only the requested image is exported
+    assert sorted(p.name for p in roundtrip_image_folder.iterdir()) == [
+        "img_2.tif",
+        "img_2_label.tif",
+    ]
+    _assert_roundtrip_matches(
+        small_multiple_image_folder / "image_2" / "img_2.tif",
+        small_multiple_image_folder / "image_2" / "label.tif",
+        roundtrip_image_folder / "img_2.tif",
+        roundtrip_image_folder / "img_2_label.tif",
     )
 
+
+@pytest.mark.parametrize("n_cpus", [1, 2])
+def test_index_list_conversion(
+    small_multiple_image_folder: pathlib.Path,
+    small_multiple_h5_file: pathlib.Path,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+    n_cpus: int,
+) -> None:
+    """Test conversion to and from h5 results in identical rasters, with and without workers."""
+    monkeypatch.setattr(conversion, "cpu_count", lambda: n_cpus)
     # convert h5 back to image
-    idx_lst = [4, 5]
-    roundtrip_image_folder = multiple_image_folder / "img_roundtrip"
-    conversion.convert_h5_to_img(src_file=h5_file, dst_folder=roundtrip_image_folder, index=idx_lst)
+    idx_lst = [1, 2]
+    roundtrip_image_folder = tmp_path / "img_roundtrip"
+    conversion.convert_h5_to_img(
+        src_file=small_multiple_h5_file, dst_folder=roundtrip_image_folder, index=idx_lst
+    )
 
     for i in idx_lst:
-        with (
-            rio.open(multiple_image_folder / f"image_{i}" / f"img_{i}.tif", "r") as original_image,
-            rio.open(multiple_image_folder / f"image_{i}" / "label.tif", "r") as original_label,
-            rio.open(roundtrip_image_folder / f"img_{i}.tif", "r") as roundtrip_image,
-            rio.open(roundtrip_image_folder / f"img_{i}_label.tif", "r") as roundtrip_label,
-        ):
-            arr_img_original = original_image.read()
-            arr_lbl_original = original_label.read()
-            arr_img_roundtrip = roundtrip_image.read()
-            arr_lbl_roundtrip = roundtrip_label.read()
-
-            assert (arr_img_original == arr_img_roundtrip).all()
-            assert (arr_lbl_original == arr_lbl_roundtrip).all()
-
-            assert original_image.meta["width"] == roundtrip_image.meta["width"]
-            assert original_image.meta["height"] == roundtrip_image.meta["height"]
-            assert original_image.meta["transform"] == roundtrip_image.meta["transform"]
-            assert original_image.meta["crs"] == roundtrip_image.meta["crs"]
-
-            assert original_label.meta["width"] == roundtrip_label.meta["width"]
-            assert original_label.meta["height"] == roundtrip_label.meta["height"]
-            assert original_label.meta["transform"] == roundtrip_label.meta["transform"]
-            assert original_label.meta["crs"] == roundtrip_label.meta["crs"]
-
-    # cleanup
-    h5_file.unlink()
-    shutil.rmtree(roundtrip_image_folder)
+        _assert_roundtrip_matches(
+            small_multiple_image_folder / f"image_{i}" / f"img_{i}.tif",
+            small_multiple_image_folder / f"image_{i}" / "label.tif",
+            roundtrip_image_folder / f"img_{i}.tif",
+            roundtrip_image_folder / f"img_{i}_label.tif",
+        )
+
+
+@pytest.mark.parametrize(
+    "file_glob",
+    [
+        "*.tif",  # labels are part of the walk over all files
+        "img_*.tif",  # labels are not, and are globbed in the image folders
+    ],
+)
+def test_labels_are_paired_with_the_images_of_their_folder(
+    small_multiple_image_folder: pathlib.Path, tmp_path: pathlib.Path, file_glob: str
+) -> None:
+    """Test every image is stored with the label of its own folder, ignoring other labels."""
+    src_folder = shutil.copytree(small_multiple_image_folder, tmp_path / "src")
+    # a label in a folder without image must neither be paired nor shift the pairing
+    (src_folder / "labels_only").mkdir()
+    _create_image(
+        src_folder / "labels_only" / "label.tif",
+        0,
+        3,
+        None,
+        FIXTURE_H,
+        FIXTURE_W,
+        np.dtype("uint8"),
+        shift=42,
+    )
+
+    h5_file = tmp_path / "img.h5"
+    conversion.convert_img_to_h5(src_folder, h5_file, file_glob, "*label*")
+
+    with h5py.File(h5_file, "r") as f:
+        assert f["lbl"].shape[0] == 3  # noqa: PLR2004
+        for k, path in enumerate(f["path"][:]):
+            folder = src_folder / f"image_{k}"
+            assert path.decode() == f"img_{k}"
+            img, _ = _read_raster(folder / f"img_{k}.tif")
+            lbl, _ = _read_raster(folder / "label.tif")
+            assert np.array_equal(f["img"][k], img)
+            assert np.array_equal(f["lbl"][k], lbl[0])
 
 
 def test__derive_metadata(single_image_folder: pathlib.Path) -> None:
-    """Test metadata derivation separately, as it is covered by multiprocessing."""
+    """Test metadata derivation separately, as it is covered by a thread pool."""
     width, height, epsg, affine, bands = conversion._derive_metadata(
         single_image_folder / "img.tif"
     )
@@ -212,35 +179,92 @@ def test__derive_metadata(single_image_folder: pathlib.Path) -> None:
     assert bands == SINGLE_IMAGE_FOLDER_IMAGE_BANDS
 
 
-def test__load_img(single_image_folder: pathlib.Path) -> None:
-    """Test loading images into dask arrays, as it might be covered by dask multiprocessing."""
-    da_img_arr = conversion._load_img(
-        single_image_folder / "img.tif", max_width=1024, max_height=1024, bands=[2, 3]
+def test_band_statistics_match_numpy(small_multiple_h5_file: pathlib.Path) -> None:
+    """Test /img_means and /img_stds match the per band mean and std computed by numpy."""
+    with h5py.File(small_multiple_h5_file, "r") as f:
+        img = f["img"][:]
+        assert f["img_means"].dtype == np.float32
+        assert np.allclose(f["img_means"][:], np.mean(img, axis=(0, 2, 3)), rtol=1e-6)
+        assert np.allclose(f["img_stds"][:], np.std(img, axis=(0, 2, 3)), rtol=1e-6)
+
+
+def test_h5_arrays_are_chunked_per_image_and_shuffled(small_multiple_h5_file: pathlib.Path) -> None:
+    """Test /img and /lbl hold one image per chunk and shuffle bytes before compressing."""
+    expected = (
+        [bitshuffle.h5.H5FILTER]
+        if bitshuffle is not None
+        else [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_LZF]
+    )
+    with h5py.File(small_multiple_h5_file, "r") as f:
+        for dset in (f["img"], f["lbl"]):
+            assert dset.chunks == (1, *dset.shape[1:])
+            assert _filter_codes(dset) == expected
+
+
+def test_h5_arrays_fall_back_to_shuffled_lzf(
+    small_multiple_image_folder: pathlib.Path,
+    tmp_path: pathlib.Path,
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Test /img and /lbl are compressed with byte shuffle+LZF if bitshuffle is unavailable."""
+    try:
+        with monkeypatch.context() as m:
+            # None entries in sys.modules make the imports fail
+            m.setitem(sys.modules, "bitshuffle", None)
+            m.setitem(sys.modules, "bitshuffle.h5", None)
+            importlib.reload(_compression)
+        assert _compression.bitshuffle is None
+        assert _compression.ARRAY_COMPRESSION.keys() == {"compression", "shuffle"}
+        assert _compression.ARRAY_COMPRESSION["compression"] == "lzf"
+        assert _compression.ARRAY_COMPRESSION["shuffle"]
+
+        monkeypatch.setattr(conversion, "ARRAY_COMPRESSION", _compression.ARRAY_COMPRESSION)
+        h5_file = tmp_path / "img.h5"
+        conversion.convert_img_to_h5(small_multiple_image_folder, h5_file, "*.tif", "*label*")
+    finally:
+        # restore the settings for any other test
+        importlib.reload(_compression)
+
+    with h5py.File(h5_file, "r") as f:
+        for dset in (f["img"], f["lbl"]):
+            assert _filter_codes(dset) == [h5py.h5z.FILTER_SHUFFLE, h5py.h5z.FILTER_LZF]
+
+
+def test__load_img(uncompressed_image_folder: pathlib.Path) -> None:
+    """Test loading images into padded arrays, as it might be covered by dask multiprocessing."""
+    img_arr = conversion._load_img(
+        uncompressed_image_folder / "img.tif", max_width=1024, max_height=1024, bands=[2, 3]
     )
 
-    assert da_img_arr.shape == (2, 1024, 1024)
+    assert img_arr.shape == (2, 1024, 1024)
+    with rio.open(uncompressed_image_folder / "img.tif", "r") as src:
+        assert np.array_equal(img_arr[:, : src.height, : src.width], src.read([2, 3]))
+    assert not img_arr[:, FIXTURE_H:].any()
+    assert not img_arr[:, :, FIXTURE_W:].any()
 
 
-def test__load_lbl(single_image_folder: pathlib.Path) -> None:
-    """Test loading images into dask arrays, as it might be covered by dask multiprocessing."""
-    da_lbl_arr = conversion._load_lbl(
-        single_image_folder / "img.tif", max_width=1024, max_height=1024
+def test__load_lbl(uncompressed_image_folder: pathlib.Path) -> None:
+    """Test loading labels into padded arrays, as it might be covered by dask multiprocessing."""
+    lbl_arr = conversion._load_lbl(
+        uncompressed_image_folder / "img.tif", max_width=1024, max_height=1024
     )
 
-    assert da_lbl_arr.shape == (1024, 1024)
+    assert lbl_arr.shape == (1024, 1024)
 
 
-def test_warning_when_images_are_of_varying_size(multiple_image_folder: pathlib.Path) -> None:
+def test_warning_when_images_are_of_varying_size(
+    multiple_image_folder_copy: pathlib.Path, tmp_path: pathlib.Path
+) -> None:
     """A warning should be emitted when images are of vastly differing sizes."""
-    folder = multiple_image_folder / "image_small_dimensions"
-    folder.mkdir(exist_ok=True)
+    folder = multiple_image_folder_copy / "image_small_dimensions"
+    folder.mkdir()
     _create_image(
         folder / "img_small_dimensions.tif",
         min_val=0,
         max_val=255,
         nbands=4,
-        nrows=200,
-        ncols=200,
+        nrows=FIXTURE_H // 4,
+        ncols=FIXTURE_W // 4,
         dtype=np.dtype("uint8"),
     )
     _create_image(
@@ -248,37 +272,34 @@ def test_warning_when_images_are_of_varying_size(multiple_image_folder: pathlib.
         min_val=0,
         max_val=255,
         nbands=None,
-        nrows=200,
-        ncols=200,
+        nrows=FIXTURE_H // 4,
+        ncols=FIXTURE_W // 4,
         dtype=np.dtype("uint8"),
     )
 
     with pytest.warns(UserWarning, match="Some images are significantly smaller than others."):
         conversion.convert_img_to_h5(
-            multiple_image_folder,
-            multiple_image_folder / "arr.h5",
+            multiple_image_folder_copy,
+            tmp_path / "arr.h5",
             "*.tif",
             "*label*",
             image_bands=[1, 2, 3, 4],
         )
 
-    shutil.rmtree(folder)
-    (multiple_image_folder / "arr.h5").unlink()
-
 
 def test_assertionerror_when_images_have_varying_number_of_bands(
-    multiple_image_folder: pathlib.Path,
+    multiple_image_folder_copy: pathlib.Path, tmp_path: pathlib.Path
 ) -> None:
     """A warning should be emitted when images are of vastly differing sizes."""
-    folder = multiple_image_folder / "image_wrong_number_of_bands"
-    folder.mkdir(exist_ok=True)
+    folder = multiple_image_folder_copy / "image_wrong_number_of_bands"
+    folder.mkdir()
     _create_image(
         folder / "img_small_dimensions.tif",
         min_val=0,
         max_val=255,
         nbands=2,
-        nrows=999,
-        ncols=999,
+        nrows=FIXTURE_H,
+        ncols=FIXTURE_W,
         dtype=np.dtype("uint8"),
     )
     _create_image(
@@ -286,17 +307,53 @@ def test_assertionerror_when_images_have_varying_number_of_bands(
         min_val=0,
         max_val=255,
         nbands=None,
-        nrows=999,
-        ncols=999,
+        nrows=FIXTURE_H,
+        ncols=FIXTURE_W,
         dtype=np.dtype("uint8"),
     )
 
     with pytest.raises(AssertionError):
         conversion.convert_img_to_h5(
-            multiple_image_folder,
-            multiple_image_folder / "arr.h5",
+            multiple_image_folder_copy,
+            tmp_path / "arr.h5",
             "*.tif",
             "*label*",
             image_bands=[1, 2, 3, 4],
         )
-    shutil.rmtree(folder)
+
+
+def _assert_roundtrip_matches(
+    original_image: pathlib.Path,
+    original_label: pathlib.Path,
+    roundtrip_image: pathlib.Path,
+    roundtrip_label: pathlib.Path,
+) -> None:
+    """Assert that roundtrip image and label match the original ones in data and georeference."""
+    # GDAL releases the GIL while opening and decoding, so read all four rasters concurrently
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        (
+            (arr_img_original, meta_img_original),
+            (arr_lbl_original, meta_lbl_original),
+            (arr_img_roundtrip, meta_img_roundtrip),
+            (arr_lbl_roundtrip, meta_lbl_roundtrip),
+        ) = executor.map(
+            _read_raster, (original_image, original_label, roundtrip_image, roundtrip_label)
+        )
+
+    assert np.array_equal(arr_img_original, arr_img_roundtrip)
+    assert np.array_equal(arr_lbl_original, arr_lbl_roundtrip)
+
+    for key in ("width", "height", "transform", "crs"):
+        assert meta_img_original[key] == meta_img_roundtrip[key]
+        assert meta_lbl_original[key] == meta_lbl_roundtrip[key]
+
+
+def _filter_codes(dset: h5py.Dataset) -> list[int]:
+    """Return the ids of the filters in the pipeline of `dset`, in the order they are applied."""
+    plist = dset.id.get_create_plist()
+    return [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+
+
+def _read_raster(path: pathlib.Path) -> tuple[np.ndarray, dict]:
+    with rio.open(path, "r") as src:
+        return src.read(), src.meta
@@ -1,16 +1,25 @@
 """Test contents of ukis_sat2h5/tiling.py."""
+import multiprocessing
 import pathlib
-import shutil
+from collections.abc import Iterator
 
+import h5py  # type: ignore
+import numpy as np
+import pytest
 import rasterio as rio  # type: ignore
 
 from ukis_sat2h5 import conversion, tiling
 
+TILE_SIZE = 64
 
-def test_single_image_tiled(single_image_folder: pathlib.Path) -> None:
-    """Test the conversion and tiling of a single image by comparing the input and tiled output."""
-    tile_size = 256
-    h5_file = single_image_folder / "img.h5"
+
+@pytest.fixture(scope="module")
+def tiled_roundtrip_folder(
+    single_image_folder: pathlib.Path, tmp_path_factory: pytest.TempPathFactory
+) -> pathlib.Path:
+    """Fixture converting, tiling and converting back a single image once for all tile tests."""
+    tmp_path = tmp_path_factory.mktemp("tiled")
+    h5_file = tmp_path / "img.h5"
     conversion.convert_img_to_h5(
         src_path=single_image_folder,
         dst_file=h5_file,
@@ -18,70 +27,155 @@ def test_single_image_tiled(single_image_folder: pathlib.Path) -> None:
         label_glob="*label*",
         image_bands=[1, 2, 3, 4],
     )
-    h5_file_tiled = single_image_folder / "img_tiled.h5"
-    tiling.tile_img_h5(h5_file, h5_file_tiled, tile_size=tile_size, overlap=128, target_size=1024)
+    h5_file_tiled = tmp_path / "img_tiled.h5"
+    tiling.tile_img_h5(h5_file, h5_file_tiled, tile_size=TILE_SIZE, overlap=32, target_size=256)
 
-    roundtrip_image_folder = single_image_folder / "img_tiled_roundtrip"
+    roundtrip_image_folder = tmp_path / "img_tiled_roundtrip"
     conversion.convert_h5_to_img(
         src_file=h5_file_tiled, dst_folder=roundtrip_image_folder, index=None
     )
+    return roundtrip_image_folder
+
+
+@pytest.mark.parametrize(("original_file", "is_label"), [("img.tif", False), ("label.tif", True)])
+def test_single_image_tiled(
+    single_image_folder: pathlib.Path,
+    tiled_roundtrip_folder: pathlib.Path,
+    original_file: str,
+    is_label: bool,
+) -> None:
+    """Test the conversion and tiling of a single image by comparing the input and tiled output."""
+    # read the original once and slice the windows of each tile from memory
+    with rio.open(single_image_folder / original_file, mode="r") as original_image:
+        original_transform = original_image.transform
+        original_full_arr = original_image.read()
+
+    for i in tiled_roundtrip_folder.rglob("img*.tif"):
+        if i.match("*label.tif") != is_label:
+            continue
+        with rio.open(i, mode="r") as test_image:
+            assert test_image.width == TILE_SIZE
+            assert test_image.height == TILE_SIZE
+            # read data
+            test_image_arr = test_image.read()
+            original_image_arr = _slice_window(
+                original_full_arr,
+                rio.windows.from_bounds(*test_image.bounds, transform=original_transform),
+            )
+
+            # As images can be padded during conversion, shapes might differ
+            if original_image_arr.shape != test_image_arr.shape:
+                b, x, y = original_image_arr.shape
+                # check number of bands matches (should be untouched by padding)
+                assert b == test_image_arr.shape[0]
+                # check if everything outside was set to 0, the chosen `constant_values`
+                assert not test_image_arr[:, x:, y:].any()
+
+                # reshape image
+                test_image_arr = test_image_arr[:, :x, :y]
 
-    with rio.open(single_image_folder / "img.tif", mode="r") as original_image:
-        for i in roundtrip_image_folder.rglob("img*.tif"):
-            if i.match("*label.tif"):
-                continue
-            with rio.open(i, mode="r") as test_image:
-                assert test_image.width == tile_size
-                assert test_image.height == tile_size
-                # read data
-                test_image_arr = test_image.read()
-                original_image_arr = original_image.read(
-                    window=rio.windows.from_bounds(
-                        *test_image.bounds, transform=original_image.transform
-                    )
+            assert np.array_equal(test_image_arr, original_image_arr)
+
+
+def test_multiple_images_tiled_in_order(
+    small_multiple_h5_file: pathlib.Path, tmp_path: pathlib.Path
+) -> None:
+    """Test tiles of every image end up at its index, also where chunks span several images."""
+    h5_file_tiled = tmp_path / "img_tiled.h5"
+    tiling.tile_img_h5(
+        small_multiple_h5_file, h5_file_tiled, tile_size=TILE_SIZE, overlap=32, target_size=256
+    )
+
+    n_tiles = ((256 - TILE_SIZE) // 32 + 1) ** 2
+    with h5py.File(small_multiple_h5_file, "r") as src, h5py.File(h5_file_tiled, "r") as dst:
+        # chunks of 32 tiles do not align with the 49 tiles per image
+        assert dst["img"].chunks[0] % n_tiles != 0
+        for k in range(src["img"].shape[0]):
+            tiles = slice(k * n_tiles, (k + 1) * n_tiles)
+            for name in ("img", "lbl"):
+                assert np.array_equal(
+                    dst[name][tiles],
+                    tiling._tile_array(src[name][k : k + 1].astype("int16"), TILE_SIZE, 32, 256),
                 )
+            assert np.array_equal(dst["epsg"][tiles], np.repeat(src["epsg"][k], n_tiles))
+            assert all(p.startswith(src["path"][k]) for p in dst["path"][tiles])
+
+
+def test__bounded_imap() -> None:
+    """Test results are yielded in order while only `max_in_flight` tasks are submitted."""
+    n_submitted = 0
+
+    def args_iter() -> Iterator[tuple[int, int]]:
+        nonlocal n_submitted
+        for i in range(10):
+            n_submitted += 1
+            yield (i, 2)
 
-                # As images can be padded during conversion, shapes might differ
-                if original_image_arr.shape != test_image_arr.shape:
-                    b, x, y = original_image_arr.shape
-                    # check number of bands matches (should be untouched by padding)
-                    assert b == test_image_arr.shape[0]
-                    # check if everything outside was set to 0, the chosen `constant_values`
-                    assert (test_image_arr[:, x:, y:] == 0).all()
-
-                    # reshape image
-                    test_image_arr = test_image_arr[:, :x, :y]
-
-                assert (test_image_arr == original_image_arr).all()
-
-    # same test but for label
-    with rio.open(single_image_folder / "label.tif", mode="r") as original_image:
-        for i in roundtrip_image_folder.rglob("img*.tif"):
-            if not i.match("*label.tif"):
-                continue
-            with rio.open(i, mode="r") as test_image:
-                assert test_image.width == tile_size
-                assert test_image.height == tile_size
-                # read data
-                test_image_arr = test_image.read()
-                original_image_arr = original_image.read(
-                    window=rio.windows.from_bounds(
-                        *test_image.bounds, transform=original_image.transform
-                    )
+    with multiprocessing.Pool(2) as pool:
+        results = tiling._bounded_imap(pool, pow, args_iter(), max_in_flight=3)
+        assert next(results) == 0
+        assert n_submitted == 3  # noqa: PLR2004
+        assert list(results) == [i**2 for i in range(1, 10)]
+
+
+def test__tile_array() -> None:
+    """Test tiles start every `overlap` pixels and are zero padded beyond the array extent."""
+    arr = np.arange(2 * 3 * 10 * 9, dtype="int16").reshape(2, 3, 10, 9) + 1
+    tiled = tiling._tile_array(arr, tile_size=4, overlap=3, pad_size=13)
+
+    # (13 - 4) // 3 + 1 = 4 tiles per side and image, ordered by image, tile row and tile column
+    assert tiled.shape == (2 * 4 * 4, 3, 4, 4)
+    padded = np.pad(arr, pad_width=((0, 0), (0, 0), (0, 3), (0, 4)))
+    for n in range(2):
+        for row in range(4):
+            for col in range(4):
+                assert np.array_equal(
+                    tiled[n * 16 + row * 4 + col],
+                    padded[n, :, row * 3 : row * 3 + 4, col * 3 : col * 3 + 4],
                 )
 
-                # As images can be padded during conversion, shapes might differ
-                if original_image_arr.shape != test_image_arr.shape:
-                    b, x, y = original_image_arr.shape
-                    # check number of bands matches (should be untouched by padding)
-                    assert b == test_image_arr.shape[0]
-                    # check if everything outside was set to 0, the chosen `constant_values`
-                    assert (test_image_arr[:, x:, y:] == 0).all()
-                    test_image_arr = test_image_arr[:, :x, :y]
-
-                assert (test_image_arr == original_image_arr).all()
-
-    # cleanup
-    h5_file.unlink()
-    h5_file_tiled.unlink()
-    shutil.rmtree(roundtrip_image_folder)
+
+def test__tile_array_single_channel() -> None:
+    """Test arrays without channel axis, e.g. labels, are tiled as a single channel."""
+    arr = np.arange(2 * 10 * 9, dtype="int16").reshape(2, 10, 9)
+    tiled = tiling._tile_array(arr, tile_size=4, overlap=3, pad_size=13)
+
+    assert tiled.shape == (2 * 4 * 4, 1, 4, 4)
+    assert np.array_equal(tiled, tiling._tile_array(arr[:, np.newaxis], 4, 3, 13))
+
+
+def test__tile_array_raises_for_arrays_larger_than_pad_size() -> None:
+    """Test arrays exceeding `pad_size` are rejected rather than cropped."""
+    with pytest.raises(ValueError, match="exceeds"):
+        tiling._tile_array(np.zeros((1, 2, 10, 14), dtype="int16"), 4, 3, pad_size=13)
+
+
+def test__auto_chunk_size() -> None:
+    """Test chunks target about 1 MiB, independent of the number of tiles per image."""
+    # 4 bands of 64 x 64 int16 pixels, i.e. 32 KiB per tile
+    assert tiling._auto_chunk_size(4 * 64 * 64 * 2, n_tiled=10 * 49) == 32  # noqa: PLR2004
+    # a prime number of tiles per side, e.g. -t 64 -o 32 -a 1024, still gets 1 MiB chunks
+    assert tiling._auto_chunk_size(4 * 64 * 64 * 2, n_tiled=10 * 31**2) == 32  # noqa: PLR2004
+    # chunks never exceed the dataset
+    assert tiling._auto_chunk_size(4 * 64 * 64 * 2, n_tiled=16) == 16  # noqa: PLR2004
+    # tiles larger than the target size still get one tile per chunk
+    assert tiling._auto_chunk_size(13 * 512 * 512 * 2, n_tiled=16) == 1
+
+
+def test__tile_affines() -> None:
+    """Test tile transforms match the upper left corners rasterio derives for each tile."""
+    # include rotation terms to cover every coefficient of the transform
+    affine = np.array([(500.0, 10.0, 2.0, 100.0, 1.0, -10.0), (0.0, 20.0, 0.0, 0.0, 0.0, -20.0)])
+    tiled = tiling._tile_affines(affine, target_size=8, tile_size=4, overlap=2, n_tiled=2 * 9)
+
+    for n, gdal_transform in enumerate(affine):
+        transformer = rio.transform.AffineTransformer(rio.Affine.from_gdal(*gdal_transform))
+        for i, (row, col) in enumerate((r, c) for r in range(0, 5, 2) for c in range(0, 5, 2)):
+            x, y = transformer.xy(row, col, offset="ul")
+            assert np.allclose(tiled[n * 9 + i], (x, *gdal_transform[1:3], y, *gdal_transform[4:]))
+
+
+def _slice_window(arr: np.ndarray, window: rio.windows.Window) -> np.ndarray:
+    """Slice a window from a (bands, rows, cols) array, clipped to the array extent."""
+    row_off, col_off = round(window.row_off), round(window.col_off)
+    return arr[:, row_off : row_off + round(window.height), col_off : col_off + round(window.width)]
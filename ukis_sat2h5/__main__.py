@@ -1,13 +1,17 @@
 """Main entry point for CLI application."""
 import argparse
+import functools
 import pathlib
 
-import ukis_sat2h5.conversion
-import ukis_sat2h5.tiling
-
 
 def parse_args(args: list[str] | None = None) -> argparse.Namespace:
     """Parse CLI arguments."""
+    return _build_parser().parse_args(args)
+
+
+@functools.cache
+def _build_parser() -> argparse.ArgumentParser:
+    """Build the CLI argument parser once, it can be reused across parse_args calls."""
     # top level parser
     parser = argparse.ArgumentParser(
         prog="ukis_sat2h5",
@@ -47,6 +51,7 @@ def parse_args(args: list[str] | None = None) -> argparse.Namespace:
         default=None,
         help="Indexes of image bands, indexed by 1, like 3 4 5",
     )
+    parser_img_to_h5.set_defaults(func=_img_to_h5_main)
 
     # H5 to images
     parser_h5_to_img = subparsers.add_parser(
@@ -75,6 +80,7 @@ def parse_args(args: list[str] | None = None) -> argparse.Namespace:
         default=None,
         help="Indexes of image bands, indexed by 1.",
     )
+    parser_h5_to_img.set_defaults(func=_h5_to_img_main)
 
     # image tiling options
     parser_tile_h5 = subparsers.add_parser(
@@ -117,51 +123,71 @@ def parse_args(args: list[str] | None = None) -> argparse.Namespace:
         "--chunk_size",
         type=int,
         help="Chunk size of output /img and /lbl datasets in output h5 file. "
-        "Setting the value too low can result in high memory consumption. Default: 1",
+        "Setting the value too low can result in high memory consumption. Default: derived for "
+        "chunks of about 1 MiB",
     )
+    parser_tile_h5.set_defaults(func=_tile_h5_main)
 
-    return parser.parse_args(args)
+    return parser
 
 
 def main() -> int:
     """Encapsulate entry point."""
     args = parse_args()
 
-    if args.command == "img_to_h5":
-        if not args.root_folder.exists():
-            print(  # noqa: T201
-                f"Root folder (-r / --root_folder {args.root_folder}) does not exist. Stopping..."
-            )
-            return 1
-        if args.dst_file.exists():
-            print(  # noqa: T201
-                f"\nDestination file (-d / --dst_file {args.dst_file}) exists. Please (re)move file"
-                " or use another destination. Stopping...",
-            )
-            return 1
-        ukis_sat2h5.conversion.convert_img_to_h5(
-            args.root_folder, args.dst_file, args.file_glob, args.label_glob, args.bands
+    if getattr(args, "func", None) is None:
+        parse_args(["-h"])
+
+    return args.func(args)
+
+
+def _img_to_h5_main(args: argparse.Namespace) -> int:
+    """Run the img_to_h5 subcommand."""
+    if not args.root_folder.exists():
+        _build_parser().error(
+            f"Root folder (-r / --root_folder {args.root_folder}) does not exist."
         )
-    elif args.command == "h5_to_img":
-        if not args.src_file.exists():
-            print(  # noqa: T201
-                f"Source file (-s / --src_file {args.root_folder}) does not exist. Stopping..."
-            )
-            return 1
-        ukis_sat2h5.conversion.convert_h5_to_img(args.src_file, args.dst_folder, args.index)
-    elif args.command == "tile_h5":
-        if args.dst_file.exists():
-            print(  # noqa: T201
-                f"\nDestination file (-d / --dst_file {args.dst_file}) exists. Please (re)move file"
-                " or use another destination. Stopping...",
-            )
-            return 1
-        ukis_sat2h5.tiling.tile_img_h5(
-            args.src_file, args.dst_file, args.tile_size, args.overlap, args.target_size
+    if args.dst_file.exists():
+        _build_parser().error(
+            f"Destination file (-d / --dst_file {args.dst_file}) exists. Please (re)move file"
+            " or use another destination."
         )
-    else:
-        parse_args(["-h"])
+    # import heavy dependencies (rasterio, h5py, dask) only when needed
+    from ukis_sat2h5 import conversion
 
+    conversion.convert_img_to_h5(
+        args.root_folder, args.dst_file, args.file_glob, args.label_glob, args.bands
+    )
+    return 0
+
+
+def _h5_to_img_main(args: argparse.Namespace) -> int:
+    """Run the h5_to_img subcommand."""
+    if not args.src_file.exists():
+        _build_parser().error(f"Source file (-s / --src_file {args.src_file}) does not exist.")
+    from ukis_sat2h5 import conversion
+
+    conversion.convert_h5_to_img(args.src_file, args.dst_folder, args.index)
+    return 0
+
+
+def _tile_h5_main(args: argparse.Namespace) -> int:
+    """Run the tile_h5 subcommand."""
+    if args.dst_file.exists():
+        _build_parser().error(
+            f"Destination file (-d / --dst_file {args.dst_file}) exists. Please (re)move file"
+            " or use another destination."
+        )
+    from ukis_sat2h5 import tiling
+
+    tiling.tile_img_h5(
+        args.src_file,
+        args.dst_file,
+        args.tile_size,
+        args.overlap,
+        args.target_size,
+        args.chunk_size,
+    )
     return 0
 
 
@@ -0,0 +1,16 @@
+"""HDF5 compression settings shared by the conversion and tiling modules."""
+try:
+    import bitshuffle.h5  # type: ignore
+except ImportError:
+    bitshuffle = None
+
+# Filters used for the large /img and /lbl datasets. Bitshuffle+LZ4 compresses low entropy uint16
+# rasters better than LZF and decompresses faster. As it is an optional dependency, fall back to
+# byte shuffle+LZF, which can be read by any h5py installation without additional plugins.
+if bitshuffle is not None:
+    ARRAY_COMPRESSION: dict = {
+        "compression": bitshuffle.h5.H5FILTER,
+        "compression_opts": (0, bitshuffle.h5.H5_COMPRESS_LZ4),
+    }
+else:
+    ARRAY_COMPRESSION = {"compression": "lzf", "shuffle": True}
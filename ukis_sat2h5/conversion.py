@@ -1,10 +1,13 @@
 """Convert an image folder to h5 array."""
 import multiprocessing
+import os
 import pathlib
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from multiprocessing import cpu_count
 
+import dask
 import dask.array as da
 import h5py  # type: ignore
 import numpy as np
@@ -12,6 +15,8 @@ import rasterio as rio  # type: ignore
 from dask.delayed import delayed
 from tqdm import tqdm  # type: ignore
 
+from ukis_sat2h5._compression import ARRAY_COMPRESSION
+
 _IMG_SIDE_RATIO_WRNG_THRS = 0.5
 
 
@@ -38,24 +43,47 @@ def convert_img_to_h5(
         Select a subset of image bands by index (starting with 1, see
         https://rasterio.readthedocs.io/en/latest/quickstart.html#reading-raster-data). By default
         (`None`), all bands will be selected.
+
+    Notes
+    -----
+    Images are read by one dask thread per CPU. When there are fewer images than CPUs, GDAL decodes
+    each image with several threads, so that all CPUs are used without oversubscribing them. Set
+    the `GDAL_NUM_THREADS` environment variable to override the number of decoding threads per
+    image, and GDAL's other configuration options, e.g. `GDAL_CACHEMAX`, as usual.
     """
-    # list all images and filter label images if they have the same file_glob
-    l_images = [
-        i
-        for i in _rglob_with_links(src_path.expanduser(), file_glob)
-        if not i.match(label_glob)
-        # TODO: Python 3.13 replace with src_path.expanduser().rglob(file_glob)  # noqa: FIX002
+    # list all files once and split them into images and the labels of their folders,
+    # as label images match the file_glob, too, in most cases
+    # TODO: Python 3.13 replace with src_path.expanduser().rglob(file_glob)  # noqa: FIX002
+    l_images = []
+    parent_labels: dict[pathlib.Path, list[pathlib.Path]] = {}
+    for p in _rglob_with_links(src_path.expanduser(), file_glob):
+        if p.match(label_glob):
+            parent_labels.setdefault(p.parent, []).append(p)
+        else:
+            l_images.append(p)
+    # find labels in the folders where images would be located, only globbing folders again
+    # if the labels were not part of the walk above
+    l_labels = [
+        j
+        for i in l_images
+        for j in (
+            parent_labels[i.parent] if i.parent in parent_labels else i.parent.glob(label_glob)
+        )
     ]
-    # find labels in the folders where images would be located
-    l_labels = [j for i in l_images for j in i.parent.glob(label_glob)]
 
     assert len(l_images) == len(
         l_labels
     ), f"Number of images ({len(l_images)}) differs from number of labels ({len(l_labels)})"
 
-    # load metadata
-    with multiprocessing.Pool(cpu_count()) as pool:
-        metadata = list(tqdm(pool.imap(_derive_metadata, l_images), desc="Load img metadata:"))
+    # load metadata, which is I/O bound and rasterio releases the GIL, hence threads suffice
+    with ThreadPoolExecutor(max_workers=min(32, cpu_count() * 4)) as executor:
+        metadata = list(
+            tqdm(
+                executor.map(_derive_metadata, l_images),
+                total=len(l_images),
+                desc="Load img metadata:",
+            )
+        )
 
     widths, heights, epsgs, affines, bands = zip(*metadata, strict=True)
 
@@ -82,9 +110,15 @@ def convert_img_to_h5(
     else:
         image_bands = list(range(1, max(bands) + 1))
 
+    # split the CPUs between the images read concurrently by dask's threads
+    gdal_threads = os.environ.get(
+        "GDAL_NUM_THREADS", max(1, cpu_count() // min(len(l_images), cpu_count()))
+    )
     img_arr_del_lst = [
         da.from_delayed(
-            delayed(_load_img)(p, max(widths), max(heights), bands=image_bands),
+            delayed(_load_img)(
+                p, max(widths), max(heights), bands=image_bands, num_threads=gdal_threads
+            ),
             shape=(len(image_bands), max(heights), max(widths)),
             dtype="uint16",
         )
@@ -92,7 +126,7 @@ def convert_img_to_h5(
     ]
     lbl_arr_del_lst = [
         da.from_delayed(
-            delayed(_load_lbl)(p, max(widths), max(heights)),
+            delayed(_load_lbl)(p, max(widths), max(heights), num_threads=gdal_threads),
             shape=(max(heights), max(widths)),
             dtype="uint16",
         )
@@ -106,22 +140,35 @@ def convert_img_to_h5(
     shortened_paths = [p.stem for p in l_images]
     max_str_len = max([len(str(p)) for p in shortened_paths])
     string_dtype = h5py.string_dtype("utf-8", max_str_len)
-    path_arr = da.from_array(np.array([str(sp) for sp in shortened_paths], dtype=string_dtype))
-
-    epsg_arr = da.from_array(np.array(epsgs))
-    affine_arr = da.from_array(np.array(affines))
-
-    da.to_hdf5(
-        dst_file.expanduser(),
-        {
-            "/img": img_arr,
-            "/lbl": lbl_arr,
-            "/path": path_arr,
-            "/epsg": epsg_arr,
-            "/affine": affine_arr,
-        },
-        compression="lzf",
-    )
+    path_arr = np.array([str(sp) for sp in shortened_paths], dtype=string_dtype)
+
+    # Pre-create image and label datasets with one image per chunk, matching the single image reads
+    # when tiling or converting the h5 file back to images. Chunking and compression filters are
+    # outsourced to h5py.File.create_dataset, the dask arrays are then stored into them.
+    with h5py.File(dst_file.expanduser(), mode="a") as dst:
+        img_dset = dst.create_dataset(
+            "/img",
+            shape=img_arr.shape,
+            chunks=(1, *img_arr.shape[1:]),
+            dtype=img_arr.dtype,
+            **ARRAY_COMPRESSION,
+        )
+        lbl_dset = dst.create_dataset(
+            "/lbl",
+            shape=lbl_arr.shape,
+            chunks=(1, *lbl_arr.shape[1:]),
+            dtype=lbl_arr.dtype,
+            **ARRAY_COMPRESSION,
+        )
+        da.store([img_arr, lbl_arr], [img_dset, lbl_dset])
+
+        # add additional data, which grows with the number of images and compresses well
+        for name, data in (
+            ("/path", path_arr),
+            ("/epsg", np.array(epsgs)),
+            ("/affine", np.array(affines)),
+        ):
+            dst.create_dataset(name, data=data, compression="lzf", shuffle=True, chunks=True)
 
     _compute_statistics(dst_file.expanduser())
 
@@ -139,63 +186,98 @@ def convert_h5_to_img(
         Destination folder images will be saved to.
     index : int | None
         Index of the array that should be converted to image.
+
+    Notes
+    -----
+    Chunks of tiled files hold several tiles. The file is therefore opened once per process with a
+    chunk cache large enough to keep one decompressed chunk of /img and /lbl, and consecutive indices
+    are handed to the same worker process, so that every chunk is decompressed about once. This
+    costs one chunk of memory per dataset and CPU.
     """
     # create destination folder if missing
     dst_folder.expanduser().mkdir(exist_ok=True)
 
-    if isinstance(index, int):
-        _create_raster(index, src_file, dst_folder)
-    else:
-        if not isinstance(index, list):
-            with h5py.File(src_file.expanduser(), mode="r") as f:
-                index_list = list(range(f["/path"].shape[0]))
-        else:
+    with h5py.File(src_file.expanduser(), mode="r") as f:
+        if isinstance(index, int):
+            index_list = [index]
+        elif isinstance(index, list):
             index_list = index
-
-        # create rasters using multiprocessing
-        with multiprocessing.Pool(cpu_count()) as pool:
-            _ = list(
-                tqdm(
-                    pool.imap_unordered(
-                        _create_raster_mp,
-                        [(i, src_file, dst_folder) for i in index_list],
-                    ),
-                    total=len(index_list),
-                )
+        else:
+            index_list = list(range(f["/path"].shape[0]))
+        tiles_per_chunk = f["/img"].chunks[0] if f["/img"].chunks else 1
+        rdcc_nbytes = _chunk_cache_nbytes(f)
+
+    # starting worker processes costs more than converting a single image
+    if len(index_list) <= 1 or cpu_count() == 1:
+        with h5py.File(src_file.expanduser(), mode="r", rdcc_nbytes=rdcc_nbytes) as f:
+            for i in index_list:
+                _create_raster(i, f, dst_folder)
+        return
+
+    # create rasters using multiprocessing, each worker keeps the source file open
+    with multiprocessing.Pool(
+        cpu_count(), initializer=_open_worker_src, initargs=(src_file, rdcc_nbytes)
+    ) as pool:
+        _ = list(
+            tqdm(
+                pool.imap_unordered(
+                    _create_raster_mp,
+                    [(i, dst_folder) for i in index_list],
+                    chunksize=tiles_per_chunk,
+                ),
+                total=len(index_list),
             )
+        )
 
 
-def _create_raster_mp(args: tuple[int, pathlib.Path, pathlib.Path]) -> None:
-    _create_raster(*args)
+# source file opened once per worker process by `_open_worker_src`
+_worker_src: h5py.File | None = None
 
 
-def _create_raster(index: int, src_file: pathlib.Path, dst_folder: pathlib.Path) -> None:
-    with h5py.File(src_file.expanduser(), mode="r") as f:
-        img = f["/img"][index]
-        lbl = f["/lbl"][index]
-        path = f["/path"][index]
-        epsg = f["/epsg"][index]
-        affine = f["/affine"][index]
-
-        metadata = {
-            "driver": "GTiff",
-            "dtype": "uint16",
-            "nodata": 0,
-            "count": img.shape[0],
-            "height": img.shape[1],
-            "width": img.shape[2],
-            "crs": rio.CRS.from_epsg(epsg),
-            "transform": rio.Affine.from_gdal(*affine),
-            "compress": "LZW",
-        }
-        with rio.open(dst_folder / f"{path.decode('UTF-8')}.tif", "w", **metadata) as dst:
-            dst.write(img.astype(rio.uint16))
-
-        metadata.update({"count": 1})
-        if len(lbl.shape) == 2:  # noqa: PLR2004
-            lbl = lbl[np.newaxis,]
-        with rio.open(dst_folder / f"{path.decode('UTF-8')}_label.tif", "w", **metadata) as dst:
-            dst.write(lbl.astype(rio.uint16))
+def _open_worker_src(src_file: pathlib.Path, rdcc_nbytes: int) -> None:
+    global _worker_src  # noqa: PLW0603
+    _worker_src = h5py.File(src_file.expanduser(), mode="r", rdcc_nbytes=rdcc_nbytes)
+
+
+def _create_raster_mp(args: tuple[int, pathlib.Path]) -> None:
+    _create_raster(args[0], _worker_src, args[1])
+
+
+def _chunk_cache_nbytes(f: h5py.File) -> int:
+    """Size the (per dataset) chunk cache to hold one decompressed chunk of /img and /lbl."""
+    chunk_nbytes = [
+        int(np.prod(d.chunks)) * d.dtype.itemsize for d in (f["/img"], f["/lbl"]) if d.chunks
+    ]
+    # never go below the HDF5 default of 1 MiB
+    return max([1024**2, *chunk_nbytes])
+
+
+def _create_raster(index: int, f: h5py.File, dst_folder: pathlib.Path) -> None:
+    img = f["/img"][index]
+    lbl = f["/lbl"][index]
+    path = f["/path"][index]
+    epsg = f["/epsg"][index]
+    affine = f["/affine"][index]
+
+    metadata = {
+        "driver": "GTiff",
+        "dtype": "uint16",
+        "nodata": 0,
+        "count": img.shape[0],
+        "height": img.shape[1],
+        "width": img.shape[2],
+        "crs": rio.CRS.from_epsg(epsg),
+        "transform": rio.Affine.from_gdal(*affine),
+        "compress": "LZW",
+    }
+    with rio.open(dst_folder / f"{path.decode('UTF-8')}.tif", "w", **metadata) as dst:
+        dst.write(img.astype(rio.uint16))
+
+    metadata.update({"count": 1})
+    if len(lbl.shape) == 2:  # noqa: PLR2004
+        lbl = lbl[np.newaxis,]
+    with rio.open(dst_folder / f"{path.decode('UTF-8')}_label.tif", "w", **metadata) as dst:
+        dst.write(lbl.astype(rio.uint16))
 
 
 def _derive_metadata(image_path: pathlib.Path) -> tuple[int, int, int, tuple, int]:
@@ -209,60 +291,87 @@ def _derive_metadata(image_path: pathlib.Path) -> tuple[int, int, int, tuple, in
 
 
 def _load_img(
-    image_file: pathlib.Path, max_width: int, max_height: int, bands: list[int]
-) -> da.Array:
-    """Prepare image arrays as generator elements."""
-    with rio.open(image_file, "r") as src_img:
-        pad_height_img = max_height - src_img.height
-        pad_width_img = max_width - src_img.width
-
+    image_file: pathlib.Path,
+    max_width: int,
+    max_height: int,
+    bands: list[int],
+    num_threads: int | str = 1,
+) -> np.ndarray:
+    """Prepare image arrays as generator elements, decoded by `num_threads` GDAL threads."""
+    with rio.Env(GDAL_NUM_THREADS=num_threads), rio.open(image_file, "r") as src_img:
         # rasterio returns (channel, height, width), a.k.a. (bands, rows, cols)
         # pytorch tensors are ([batch], channel, height, width); no reshape necessary!
-        return da.pad(
-            da.from_array(src_img.read(bands)),
-            pad_width=((0, 0), (0, pad_height_img), (0, pad_width_img)),
-            # TODO: refactor mode to CLI option, to add "reflect"  # noqa: FIX002
-            # however this requires the x and y dimension assertions to be more concise as
-            # reflections fail with when, e.g. twice the amount of pixels is needed..
-            # TODO: in case of "reflect" a valid-pixels-mask should be exportet, too  # noqa: FIX002
-            mode="constant",
-            # TODO: Refactor constant values to CLI option  # noqa: FIX002
-            constant_values=0,
-        )
+        # reading into the upper left corner of a zeroed buffer pads the image in place
+        # TODO: refactor padding to CLI option, to add "reflect" and other constant values  # noqa: FIX002
+        # however this requires the x and y dimension assertions to be more concise as
+        # reflections fail with when, e.g. twice the amount of pixels is needed..
+        # TODO: in case of "reflect" a valid-pixels-mask should be exportet, too  # noqa: FIX002
+        out = np.zeros((len(bands), max_height, max_width), dtype="uint16")
+        src_img.read(bands, out=out[:, : src_img.height, : src_img.width])
+        return out
+
+
+def _load_lbl(
+    image_file: pathlib.Path, max_width: int, max_height: int, num_threads: int | str = 1
+) -> np.ndarray:
+    """Prepare label arrays as generator elements, decoded by `num_threads` GDAL threads."""
+    with (
+        rio.Env(GDAL_NUM_THREADS=num_threads),
+        rio.open(image_file.parent / "label.tif", "r") as src_lbl,
+    ):
+        # TODO: see above in _load_img  # noqa: FIX002
+        out = np.zeros((max_height, max_width), dtype="uint16")
+        src_lbl.read(1, out=out[: src_lbl.height, : src_lbl.width])
+        return out
 
 
-def _load_lbl(image_file: pathlib.Path, max_width: int, max_height: int) -> da.Array:
-    """Prepare label arrays as generator elements."""
-    with rio.open(image_file.parent / "label.tif", "r") as src_lbl:
-        pad_height_lbl = max_height - src_lbl.height
-        pad_width_lbl = max_width - src_lbl.width
+def _compute_statistics(h5_file: pathlib.Path) -> None:
+    """Compute band statistics across all three split h5-files.
 
-        return da.pad(
-            da.from_array(src_lbl.read(1)),
-            pad_width=((0, pad_height_lbl), (0, pad_width_lbl)),
-            # TODO: see above in _load_img  # noqa: FIX002
-            mode="constant",
-            constant_values=0,
+    Dask blocks are aligned with the on-disk chunks of /img, i.e. one image each. Every dask thread
+    therefore holds one decompressed image, plus a single band in float64 while squaring it.
+    """
+    with h5py.File(h5_file, "a") as f:
+        # align dask blocks with the on-disk chunks, so each chunk is decompressed exactly once
+        arr = da.from_array(f["img"], chunks=f["img"].chunks)
+
+        # accumulate sums and sums of squares in one pass over the data, computing them together
+        # lets both reductions share the reading and decompression of each chunk. Both cast to
+        # float64 only inside the reductions, so blocks are never copied as a whole to float64
+        block_sums_of_squares = arr.map_blocks(
+            _block_sums_of_squares,
+            chunks=tuple(c if axis == 1 else (1,) * len(c) for axis, c in enumerate(arr.chunks)),
+            dtype="float64",
         )
+        sums, sums_of_squares = dask.compute(
+            arr.sum(axis=(0, 2, 3), dtype="float64"), block_sums_of_squares.sum(axis=(0, 2, 3))
+        )
+        n = arr.shape[0] * arr.shape[2] * arr.shape[3]
+        means = sums / n
+        stds = np.sqrt(np.maximum(sums_of_squares / n - means**2, 0))
 
+        # single precision is plenty for normalization and halves the bytes
+        f.create_dataset("/img_means", data=means, dtype="f4")
+        f.create_dataset("/img_stds", data=stds, dtype="f4")
 
-def _compute_statistics(h5_file: pathlib.Path) -> None:
-    """Compute band statistics across all three split h5-files."""
-    with h5py.File(h5_file, "a") as f:
-        arr = da.from_array(f["img"])
-
-        stds = da.std(arr, axis=(0, 2, 3)).compute()
-        means = da.mean(arr, axis=(0, 2, 3)).compute()
 
-        f.create_dataset("/img_means", data=means)
-        f.create_dataset("/img_stds", data=stds)
+def _block_sums_of_squares(block: np.ndarray) -> np.ndarray:
+    """Sum the squares of an (images, bands, rows, cols) block per band, one band at a time."""
+    sums_of_squares = np.empty((1, block.shape[1], 1, 1), dtype="float64")
+    for band in range(block.shape[1]):
+        sums_of_squares[0, band] = np.square(block[:, band], dtype="float64").sum()
+    return sums_of_squares
 
 
 def _rglob_with_links(path: pathlib.Path, pattern: str) -> list[pathlib.Path]:
     """Recursive globbing fix since pathlib.Path().rglob() does not support symlinks."""
     # TODO: Python 3.13: should be obsolete  # noqa: FIX002
     #       see https://github.com/python/cpython/issues/77609
-    return [pathlib.Path(p) for p in glob(f"{path}/**/{pattern}", recursive=True)]  # noqa: PTH207
+    # sort to keep the order of images inside the h5 arrays independent of the file system
+    return [
+        pathlib.Path(p)
+        for p in sorted(glob(f"{path}/**/{pattern}", recursive=True))  # noqa: PTH207
+    ]
 
 
 if __name__ == "__main__":
@@ -1,11 +1,18 @@
 """Tile an images stored in a h5 file produced by sat2h5.conversion.convert_sat_to_h5."""
+import collections
+import multiprocessing
 import pathlib
-from itertools import chain
+from collections.abc import Callable, Iterable, Iterator
+from multiprocessing import cpu_count
+from multiprocessing.pool import Pool
 
-import dask.array as da
 import h5py  # type: ignore
 import numpy as np
-import rasterio as rio  # type: ignore
+from tqdm import tqdm  # type: ignore
+
+from ukis_sat2h5._compression import ARRAY_COMPRESSION
+
+_TARGET_CHUNK_BYTES = 1 << 20
 
 
 def tile_img_h5(
@@ -14,7 +21,7 @@ def tile_img_h5(
     tile_size: int,
     overlap: int,
     target_size: int,
-    chunk_size: int | None = 1,
+    chunk_size: int | None = None,
 ) -> None:
     """Tile image array and provide tiled transforms for h5 files created by ukis_sat2h5.conversion.
 
@@ -33,97 +40,128 @@ def tile_img_h5(
         divider between the array's target size and `tile_size`, e.g. `tile_size=256`, `overlap=128`
         then `target_size` can be set to 1024
     chunk_size : int | None
-        Size of chunks for /img and /lbl datasets in output h5_file. Setting chunk_size to low
-        values can lead to very high memory consumption.
+        Number of tiles per chunk for /img and /lbl datasets in output h5_file. By default (`None`),
+        it is derived per dataset so that chunks are about 1 MiB. Chunks may span the tiles of
+        consecutive images. Chunks of a single small tile (e.g. `chunk_size=1`) make reading large
+        files slow, as every chunk costs a B-tree lookup and a decompression. Setting chunk_size to
+        low values can also lead to very high memory consumption.
     """
     with h5py.File(src_file) as f:
         # get items from original file
-        img = da.from_array(f["img"], chunks=(1, None, None, None)).astype("int16")
-        lbl = da.from_array(f["lbl"], chunks=(1, None, None)).astype("int16")
-        lbl = np.expand_dims(lbl, axis=1)
-        img_means = da.from_array(f["img_means"]).astype("int16")
-        img_stds = da.from_array(f["img_stds"]).astype("int16")
-        path = da.from_array(f["path"]).compute()
-        epsg = da.from_array(f["epsg"])
-        affine = da.from_array(f["affine"]).compute()
-
-        n_tiles = (((target_size - tile_size) // overlap) + 1) ** 2
-
-        img_tiled = da.map_blocks(
-            _tile_array,
-            img,
-            tile_size,
-            overlap,
-            target_size,
-            chunks=(n_tiles, img.shape[1], tile_size, tile_size),
-            dtype=img.dtype,
-        )
-        lbl_tiled = da.map_blocks(
-            _tile_array,
-            lbl,
-            tile_size,
-            overlap,
-            target_size,
-            chunks=(n_tiles, lbl.shape[1], tile_size, tile_size),
-            dtype=lbl.dtype,
-        )
-
-        # include the corresponding file paths
-        path_tiled = _tile_paths(path, n_tiles, img_tiled)
-        epsg_tiled = _tile_epsgs(epsg, n_tiles, img_tiled)
-        affine_tiled = _tile_affines(affine, target_size, tile_size, overlap, img_tiled)
-
-        # In order to avoid rechunking the array with dask, a more convoluted saving procedure is
-        # chosen over the more straight-forward da.to_hdf5(). Using da.store instead, allows
-        # chunking to be outsourced to h5py.File.create_dataset.
-        with h5py.File(dst_file, mode="a") as dst:
-            # image
-            img_dset = dst.create_dataset(
-                "/img",
-                shape=img_tiled.shape,
-                chunks=(chunk_size, *img_tiled.shape[1:]),
-                dtype=img_tiled.dtype,
-                compression="lzf",
-                shuffle=True,
-            )
-            da.store(img_tiled, img_dset)
-
-            # label
-            lbl_dset = dst.create_dataset(
-                "/lbl",
-                shape=lbl_tiled.shape,
-                chunks=(chunk_size, *lbl_tiled.shape[1:]),
-                dtype=lbl_tiled.dtype,
-                compression="lzf",
-                shuffle=True,
+        n_images, n_bands = f["img"].shape[:2]
+        img_means = f["img_means"][:].astype("float32")
+        img_stds = f["img_stds"][:].astype("float32")
+        path = f["path"][:]
+        epsg = f["epsg"][:]
+        affine = f["affine"][:]
+
+    n_tiles = (((target_size - tile_size) // overlap) + 1) ** 2
+    n_tiled = n_images * n_tiles
+
+    # include the corresponding file paths
+    path_tiled = _tile_paths(path, n_tiles, n_tiled)
+    epsg_tiled = _tile_epsgs(epsg, n_tiles, n_tiled)
+    affine_tiled = _tile_affines(affine, target_size, tile_size, overlap, n_tiled)
+
+    # Create the tiled datasets upfront, so that each image can be read and tiled by its own worker
+    # process. Chunking is outsourced to h5py.File.create_dataset. HDF5 does not support concurrent
+    # writes, hence workers only read and tile while this process is the single writer. As workers
+    # tile faster than this process compresses and writes, at most two images per worker are in
+    # flight, so that only the tiles of a few images are held in memory at a time. Results are
+    # written in image order, keeping chunks shared by consecutive images in the chunk cache.
+    # The pool is started before opening the destination file, so that no open file handle is
+    # forked into workers.
+    n_workers = cpu_count()
+    with multiprocessing.Pool(n_workers) as pool, h5py.File(dst_file, mode="a") as dst:
+        dsets = {}
+        for name, n_channels in (("/img", n_bands), ("/lbl", 1)):
+            dsets[name] = dst.create_dataset(
+                name,
+                shape=(n_tiled, n_channels, tile_size, tile_size),
+                chunks=(
+                    chunk_size
+                    or _auto_chunk_size(
+                        n_channels * tile_size**2 * np.dtype("int16").itemsize, n_tiled
+                    ),
+                    n_channels,
+                    tile_size,
+                    tile_size,
+                ),
+                dtype="int16",
+                **ARRAY_COMPRESSION,
             )
-            da.store(lbl_tiled, lbl_dset)
-
-        # add additional data
-        da.to_hdf5(
-            dst_file,
-            {
-                "/img_means": img_means,
-                "/img_stds": img_stds,
-                "/path": path_tiled,
-                "/epsg": epsg_tiled,
-                "/affine": affine_tiled,
-            },
-            compression="lzf",
-            chunks=True,
-            shuffle=True,
-        )
+
+        for index, img_tiled, lbl_tiled in tqdm(
+            _bounded_imap(
+                pool,
+                _tile_one,
+                ((i, src_file, tile_size, overlap, target_size) for i in range(n_images)),
+                max_in_flight=2 * n_workers,
+            ),
+            total=n_images,
+            desc="Tile images:",
+        ):
+            dsets["/img"][index * n_tiles : (index + 1) * n_tiles] = img_tiled
+            dsets["/lbl"][index * n_tiles : (index + 1) * n_tiles] = lbl_tiled
+
+        # add additional data. The band statistics hold one value per band and are written
+        # uncompressed, whereas the per tile arrays grow with the number of tiles and compress well
+        dst.create_dataset("/img_means", data=img_means, dtype="f4")
+        dst.create_dataset("/img_stds", data=img_stds, dtype="f4")
+        for name, data in (("/path", path_tiled), ("/epsg", epsg_tiled), ("/affine", affine_tiled)):
+            dst.create_dataset(name, data=data, compression="lzf", shuffle=True, chunks=True)
+
+
+def _bounded_imap(
+    pool: Pool, func: Callable, args_iter: Iterable[tuple], max_in_flight: int
+) -> Iterator:
+    """Yield `func(*args)` for all `args_iter` in order, submitting at most `max_in_flight` tasks.
+
+    Unlike `Pool.imap`, results not consumed yet do not pile up without limit.
+    """
+    pending: collections.deque = collections.deque()
+    for args in args_iter:
+        pending.append(pool.apply_async(func, args))
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def _tile_one(
+    index: int, src_file: pathlib.Path, tile_size: int, overlap: int, target_size: int
+) -> tuple[int, np.ndarray, np.ndarray]:
+    """Tile image and label at `index` of `src_file`."""
+    with h5py.File(src_file, mode="r") as f:
+        img = f["img"][index].astype("int16")
+        lbl = f["lbl"][index].astype("int16")
+
+    img_tiled = _tile_array(img[np.newaxis], tile_size, overlap, target_size)
+    lbl_tiled = _tile_array(lbl[np.newaxis], tile_size, overlap, target_size)
+    return index, img_tiled, lbl_tiled
+
+
+def _auto_chunk_size(bytes_per_tile: int, n_tiled: int) -> int:
+    """Derive the number of tiles per chunk for chunks of about `_TARGET_CHUNK_BYTES`.
+
+    Chunks are not aligned to images, as this could shrink them to a single tile whenever the
+    number of tiles per image has no divisor close to the target. As this process is the only
+    writer, chunks shared by consecutive images are safe.
+    """
+    return max(1, min(n_tiled, _TARGET_CHUNK_BYTES // bytes_per_tile))
 
 
 def _tile_array(arr: np.ndarray, tile_size: int, overlap: int, pad_size: int = 1024) -> np.ndarray:
     """Tile an array with overlap.
 
-    First, all input images get padded to target_size for even tiling.
+    Input images are treated as if zero padded to `pad_size` for even tiling. The padding is never
+    materialized, only the parts of tiles intersecting the input array are copied.
 
     Parameters
     ----------
     arr : numpy.ndarray
-        input array
+        input array of shape (images, channels, height, width), or (images, height, width) for
+        single channel arrays such as labels
     tile_size : int
         desired size of tiled array
     overlap : int
@@ -135,89 +173,81 @@ def _tile_array(arr: np.ndarray, tile_size: int, overlap: int, pad_size: int = 1
     -------
     numpy.ndarray
         array of size (tiles, channels, tile_size, tile_size)
+
+    Raises
+    ------
+    ValueError
+        If the array is larger than `pad_size` in height or width.
     """
-    # pad image/label to target_size
+    if arr.ndim == 3:  # noqa: PLR2004
+        # a view with a channel axis of one, so labels need no extra handling below
+        arr = arr[:, np.newaxis]
     h = arr.shape[-2]
     w = arr.shape[-1]
     c = arr.shape[-3]
-    pad_h = pad_size - h
-    pad_w = pad_size - w
-    padded = np.pad(
-        arr, pad_width=((0, 0), (0, 0), (0, pad_h), (0, pad_w)), mode="constant", constant_values=0
-    )
+    if h > pad_size or w > pad_size:
+        # padding cannot shrink arrays, do not silently crop them either
+        msg = f"Array of size {h} x {w} exceeds the size it should be padded to ({pad_size=})."
+        raise ValueError(msg)
+    n_tiles_per_side = (pad_size - tile_size) // overlap + 1
 
-    # use strides for creating windows
-    strided = np.lib.stride_tricks.sliding_window_view(
-        padded, window_shape=(c, tile_size, tile_size), axis=(1, 2, 3)
-    )  # type: ignore
+    # instead of padding the whole array to pad_size, start from zero filled tiles and only copy the
+    # part of each tile that intersects with the array. Tiles entirely in the padding stay zero.
+    tiled = np.zeros(
+        (arr.shape[0], n_tiles_per_side, n_tiles_per_side, c, tile_size, tile_size), dtype=arr.dtype
+    )
+    for i, row in enumerate(range(0, min(h, pad_size - tile_size + 1), overlap)):
+        row_end = min(row + tile_size, h)
+        for j, col in enumerate(range(0, min(w, pad_size - tile_size + 1), overlap)):
+            col_end = min(col + tile_size, w)
+            tiled[:, i, j, :, : row_end - row, : col_end - col] = arr[
+                :, :, row:row_end, col:col_end
+            ]
 
-    # slice by with distance of overlap
-    return strided[:, :, ::overlap, ::overlap].reshape(-1, c, tile_size, tile_size)
+    return tiled.reshape(-1, c, tile_size, tile_size)
 
 
 def _tile_affines(
-    affine: da.Array, target_size: int, tile_size: int, overlap: int, img_tiled: da.Array
-) -> da.Array:
-    """Derive new affine projection tuples from for each image."""
-    affine_tiled = da.from_array(
-        np.array(
-            list(
-                chain.from_iterable(
-                    [_tile_one_affine(a, target_size, tile_size, overlap) for a in affine]
-                )
-            )
-        )
-    )
-    assert (
-        img_tiled.shape[0] == affine_tiled.shape[0]
-    ), f"{img_tiled.shape[0]=} != {affine_tiled.shape[0]=}"
-    return affine_tiled
+    affine: np.ndarray, target_size: int, tile_size: int, overlap: int, n_tiled: int
+) -> np.ndarray:
+    """Derive new affine projection tuples for all tiles of each image.
 
+    `affine` holds one GDAL ordered transform `(x0, a, b, y0, d, e)` per image. The upper left
+    corner of the tile at pixel `(row, col)` is `(x0 + a * col + b * row, y0 + d * col + e * row)`,
+    which is evaluated for all tiles of all images at once.
+    """
+    offsets = np.arange(0, target_size - tile_size + 1, overlap)
+    rows, cols = (o.ravel()[np.newaxis] for o in np.meshgrid(offsets, offsets, indexing="ij"))
+    x0, a, b, y0, d, e = (affine[:, i : i + 1] for i in range(6))
+
+    affine_tiled = np.empty((affine.shape[0], rows.shape[1], 6), dtype="float64")
+    affine_tiled[...] = affine[:, np.newaxis]
+    affine_tiled[..., 0] = x0 + a * cols + b * rows
+    affine_tiled[..., 3] = y0 + d * cols + e * rows
+    affine_flat = affine_tiled.reshape(-1, 6)
+    assert n_tiled == affine_flat.shape[0], f"{n_tiled=} != {affine_flat.shape[0]=}"
+    return affine_flat
 
-def _tile_epsgs(epsg: da.Array, n_tiles: int, img_tiled: da.Array) -> da.Array:
+
+def _tile_epsgs(epsg: np.ndarray, n_tiles: int, n_tiled: int) -> np.ndarray:
     """Replicate the EPSG codes by the number of tiles."""
-    epsg_tiled = da.from_array(np.repeat(np.array(epsg), n_tiles))
-    assert (
-        img_tiled.shape[0] == epsg_tiled.shape[0]
-    ), f"{img_tiled.shape[0]=} != {epsg_tiled.shape[0]=}"
+    epsg_tiled = np.repeat(epsg, n_tiles)
+    assert n_tiled == epsg_tiled.shape[0], f"{n_tiled=} != {epsg_tiled.shape[0]=}"
     return epsg_tiled
 
 
-def _tile_paths(path: da.Array, n_tiles: int, img_tiled: da.Array) -> da.Array:
+def _tile_paths(path: np.ndarray, n_tiles: int, n_tiled: int) -> np.ndarray:
     """Replicate the paths by number of tiles and append a tile index."""
-    max_path_chrs = max([len(p.decode("utf-8")) for p in path]) + len(str(n_tiles)) + 1  # + 1 for _
-    string_dtype = h5py.string_dtype("utf-8", max_path_chrs)
-    path_tiled = da.from_array(
-        np.array(
-            [f"{p.decode('UTF-8')}_{i:0{len(str(n_tiles))}}" for p in path for i in range(n_tiles)],
-            dtype=string_dtype,
-        )
-    )
-    assert (
-        img_tiled.shape[0] == path_tiled.shape[0]
-    ), f"{img_tiled.shape[0]=} != {path_tiled.shape[0]=}"
+    # work on the utf-8 encoded bytes directly, byte lengths are what the fixed length h5 strings need
+    idx_suffixes = np.array([f"_{i:0{len(str(n_tiles))}}".encode() for i in range(n_tiles)])
+    tiled = np.char.add(np.asarray(path, dtype=bytes)[:, np.newaxis], idx_suffixes).ravel()
+    string_dtype = h5py.string_dtype("utf-8", int(np.char.str_len(tiled).max()))
+    path_tiled = tiled.astype(string_dtype)
+    assert n_tiled == path_tiled.shape[0], f"{n_tiled=} != {path_tiled.shape[0]=}"
 
     return path_tiled
 
 
-def _tile_one_affine(
-    affine: tuple[float], target_size: int, tile_size: int, overlap: int
-) -> list[tuple[float]]:
-    """Create affine transforms for all tiles of an image based on target_size and overlap."""
-    return [
-        _affine_from_rowcol(affine, row, col)
-        for row in range(0, target_size - tile_size + 1, overlap)
-        for col in range(0, target_size - tile_size + 1, overlap)
-    ]
-
-
-def _affine_from_rowcol(affine: tuple[float], row: int, col: int) -> rio.Affine:
-    """Derive a new affine transform from exisitng affine and rows/cols."""
-    at = rio.transform.AffineTransformer(rio.Affine.from_gdal(*affine))
-    x, y = at.xy(row, col, offset="ul")
-    return (x, *affine[1:3], y, *affine[-2:])
-
-
 if __name__ == "__main__":
     # tile_img_h5(  # noqa: ERA001,RUF100
     #     src_file=pathlib.Path("~/tmp/images.h5").expanduser(),  # noqa: ERA001